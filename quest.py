@@ -2,18 +2,51 @@
 """QuestGame – daily quest system for indie makers. Zero external dependencies."""
 
 import argparse
+import array
+import base64
+import bisect
+import contextlib
+import copy
 import datetime
+import gc
 import hashlib
 import http.server
 import json
 import os
 import random
+import re
 import subprocess
+import stat
 import sys
+import tempfile
 import threading
+import time
+import unicodedata
+import urllib.parse
 import webbrowser
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, writes stay atomic
+    fcntl = None
 
 BASE = os.path.dirname(os.path.abspath(__file__))
+WRITE_RETRIES = 8
+WRITE_BACKOFF = 0.01  # seconds; doubled per retry, randomized
+
+# mkstemp creates 0600 files: new data files get the usual umask mode instead
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class ConcurrentWriteError(Exception):
+    pass
+
+
+class StaleWriteError(ConcurrentWriteError):
+    # the file changed on disk since it was read; callers reload and retry
+    pass
 
 # ---------------------------------------------------------------------------
 # File helpers
@@ -23,18 +56,98 @@ def path(name):
     return os.path.join(BASE, name)
 
 
-def read_json(name, default=None):
+@contextlib.contextmanager
+def file_lock(name):
+    # serializes writers of one data file. The lock lives in a sibling
+    # ".<name>.lock": os.replace swaps the inode of the data file itself, so
+    # a lock held on it would not survive a write. Readers need no lock,
+    # they always see a whole file.
+    if fcntl is None:
+        yield
+        return
+    with open(path(f".{name}.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _load_json(name, default):
     p = path(name)
     if not os.path.exists(p):
-        return default
+        # never hand out the shared default: callers mutate what they get
+        return copy.deepcopy(default)
     with open(p, "r", encoding="utf-8") as f:
         return json.load(f)
 
 
-def write_json(name, data):
-    with open(path(name), "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
-        f.write("\n")
+def _replace_json(name, data, compact=False):
+    target = path(name)
+    try:
+        mode = stat.S_IMODE(os.stat(target).st_mode)
+    except FileNotFoundError:
+        mode = 0o666 & ~_UMASK
+    fd, tmp = tempfile.mkstemp(dir=BASE, prefix=f".{name}.", suffix=".tmp")
+    try:
+        os.chmod(tmp, mode)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            if compact:
+                json.dump(data, f, separators=(",", ":"), ensure_ascii=False)
+            else:
+                json.dump(data, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+            f.flush()
+            os.fsync(f.fileno())
+            written = os.fstat(f.fileno())
+        os.replace(tmp, target)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    # stat of what we wrote (replace keeps it), not of whatever is there now
+    return written
+
+
+def file_version(st):
+    # identity of one written version of a file: os.replace gives every
+    # write a new inode, in-place writers change size or mtime
+    return (st.st_ino, st.st_size, st.st_mtime_ns) if st is not None else None
+
+
+def read_json(name, default=None):
+    return _load_json(name, default)
+
+
+def write_json(name, data, compact=False):
+    with file_lock(name):
+        return _replace_json(name, data, compact)
+
+
+def _backoff(attempt):
+    # randomized so writers that keep colliding stop doing so in lockstep
+    time.sleep(random.uniform(0.5, 1.5) * WRITE_BACKOFF * 2 ** (attempt - 1))
+
+
+def update_json(name, mutate, default=None):
+    # optimistic read-modify-write: mutate(data) runs unlocked and is only
+    # written if "revision" on disk did not move meanwhile, otherwise it is
+    # re-applied to fresh data. mutate returning None skips the write.
+    for attempt in range(WRITE_RETRIES):
+        if attempt:
+            _backoff(attempt)
+        data = read_json(name, default)
+        revision = data.get("revision", 0)
+        result = mutate(data)
+        if result is None:
+            return data, None
+        with file_lock(name):
+            current = _load_json(name, default)
+            if current.get("revision", 0) == revision:
+                data["revision"] = revision + 1
+                _replace_json(name, data)
+                return data, result
+    raise ConcurrentWriteError(f"{name}: muitas escritas concorrentes, tente de novo")
 
 
 def read_text(name):
@@ -72,6 +185,7 @@ def today_str():
 
 DEFAULT_STATE = {
     "version": 1,
+    "revision": 0,
     "player": {
         "name": "player",
         "xp": 0,
@@ -142,6 +256,545 @@ def detect_category(text):
             return cat
     return "build"
 
+# ---------------------------------------------------------------------------
+# Backlog model – slotted items inside a lazily decoded container
+# ---------------------------------------------------------------------------
+
+CATEGORIES = ("build", "ship", "reach")
+CATEGORY_INDEX = {cat: i for i, cat in enumerate(CATEGORIES)}
+CATEGORY_CODES = {cat[0]: cat for cat in CATEGORIES}
+
+_MISSING = object()
+
+
+class BacklogItem:
+    """Compact backlog entry. Category is kept as an index into CATEGORIES.
+
+    Unset slots mean the key was absent in backlog.json; unknown keys are kept
+    in `extra`, so to_dict() reproduces the original item.
+    """
+
+    FIELDS = ("id", "title", "category", "impact", "effort_minutes", "notes", "created_at")
+    __slots__ = ("id", "title", "_cat", "impact", "effort_minutes", "notes", "created_at", "extra")
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict):
+            raise ValueError(f"backlog item must be an object, got {type(data).__name__}")
+        item = cls.__new__(cls)
+        item.extra = None
+        for key, value in data.items():
+            if key == "category" and value in CATEGORY_INDEX:
+                item._cat = CATEGORY_INDEX[value]
+            elif key in _FIELD_SET and key != "category":
+                setattr(item, key, value)
+            else:
+                item[key] = value
+        return item
+
+    @property
+    def category(self):
+        try:
+            return CATEGORIES[self._cat]
+        except AttributeError:
+            if self.extra and "category" in self.extra:
+                return self.extra["category"]
+            raise
+
+    @category.setter
+    def category(self, value):
+        if value in CATEGORY_INDEX:
+            self._cat = CATEGORY_INDEX[value]
+        else:
+            # unknown category: keep it verbatim so the file round-trips
+            if hasattr(self, "_cat"):
+                del self._cat
+            self.extra = self.extra or {}
+            self.extra["category"] = value
+
+    def get(self, key, default=None):
+        if key in _FIELD_SET:
+            return getattr(self, key, default)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        return default
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in _FIELD_SET:
+            setattr(self, key, value)
+        else:
+            self.extra = self.extra or {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def to_dict(self):
+        out = {}
+        for key in self.FIELDS:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                out[key] = value
+        if self.extra:
+            for key, value in self.extra.items():
+                out.setdefault(key, _plain(value))
+        return out
+
+    def __repr__(self):
+        return f"BacklogItem({self.get('id')!r}, {self.get('title')!r})"
+
+
+_FIELD_SET = frozenset(BacklogItem.FIELDS)
+
+
+def _backlog_object(d):
+    # object_hook for backlog.json: items become BacklogItems while the C
+    # decoder runs, so the list of plain dicts never exists. The common
+    # 7-field shape skips from_dict's generic loop.
+    if "id" not in d or "items" in d:
+        return d
+    if len(d) == 7:
+        try:
+            item = BacklogItem.__new__(BacklogItem)
+            item.extra = None
+            item.id = d["id"]
+            item.title = d["title"]
+            item._cat = CATEGORY_INDEX[d["category"]]
+            item.impact = d["impact"]
+            item.effort_minutes = d["effort_minutes"]
+            item.notes = d["notes"]
+            item.created_at = d["created_at"]
+            return item
+        except (KeyError, TypeError):
+            pass
+    return BacklogItem.from_dict(d)
+
+
+def _plain(value):
+    # undo the hook for nested objects that merely had an "id" key
+    if isinstance(value, BacklogItem):
+        return value.to_dict()
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    return value
+
+
+class Backlog:
+    """List of slotted BacklogItems loaded from backlog.json.
+
+    Items are built by an object_hook during parsing. Other top-level keys
+    are kept in _meta and written back as-is.
+
+    Every save bumps a "generation" counter in the file; together with the
+    mtime of the version read or written, stamp() tells derived indexes which
+    backlog they match.
+    """
+
+    __slots__ = ("_items", "_meta", "mtime", "version")
+
+    def __init__(self):
+        self._items = []
+        self._meta = {}
+        self.mtime = None
+        self.version = None  # file_version() of what was loaded or saved
+
+    @classmethod
+    def load(cls, name="backlog.json"):
+        backlog = cls()
+        p = path(name)
+        if not os.path.exists(p):
+            return backlog
+        # the cyclic GC only rescans the freshly allocated items during a
+        # bulk load; pausing it keeps parsing close to plain json.load
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(p, "r", encoding="utf-8") as f:
+                data = json.load(f, object_hook=_backlog_object)
+                st = os.fstat(f.fileno())
+                backlog.mtime = st.st_mtime_ns
+                backlog.version = file_version(st)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if not isinstance(data, dict):
+            raise ValueError("backlog.json must be an object with an \"items\" list")
+        items = data.pop("items", [])
+        backlog._items = [
+            i if isinstance(i, BacklogItem) else BacklogItem.from_dict(i) for i in items
+        ]
+        backlog._meta = data
+        return backlog
+
+    def stamp(self):
+        return {"generation": self._meta.get("generation", 0), "backlog_mtime": self.mtime}
+
+    def save(self, name="backlog.json"):
+        # optimistic: refuse to overwrite a version this backlog was not
+        # loaded from (another triage/plan, the Bun server)
+        with file_lock(name):
+            try:
+                current = file_version(os.stat(path(name)))
+            except FileNotFoundError:
+                current = None
+            if current != self.version:
+                raise StaleWriteError(f"{name}: alterado por outro processo")
+            self._meta["generation"] = self._meta.get("generation", 0) + 1
+            written = _replace_json(name, self.to_dict())
+        self.mtime = written.st_mtime_ns
+        self.version = file_version(written)
+
+    def to_dict(self):
+        return {"items": [item.to_dict() for item in self._items], **self._meta}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, i):
+        return self._items[i]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def values(self, key, default=None):
+        for item in self._items:
+            yield item.get(key, default)
+
+    def index_of(self, item_id):
+        for i, value in enumerate(self.values("id")):
+            if value == item_id:
+                return i
+        return -1
+
+    def append(self, item):
+        if not isinstance(item, BacklogItem):
+            item = BacklogItem.from_dict(item)
+        self._items.append(item)
+        return item
+
+    def remove(self, item_id):
+        i = self.index_of(item_id)
+        if i < 0:
+            return None
+        return self._items.pop(i)
+
+# ---------------------------------------------------------------------------
+# Search index – inverted index over backlog titles and notes
+# ---------------------------------------------------------------------------
+
+INDEX_FILE = "backlog.index.json"
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def normalize_text(text):
+    # lowercase and strip accents so "versão" and "versao" match
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(normalize_text(text))
+
+
+def item_tokens(item):
+    return set(tokenize(f"{item.get('title', '')} {item.get('notes', '')}"))
+
+
+def item_fingerprint(item):
+    # everything the index derives postings from; a change means re-index
+    key = "\x1f".join(str(item.get(k, "")) for k in ("title", "notes", "category", "effort_minutes"))
+    return zlib.crc32(key.encode("utf-8"))
+
+
+class SearchIndex:
+    """Postings (token, category and effort -> item ids) kept next to the backlog.
+
+    Updated item by item via add()/remove() and saved with the stamp of the
+    backlog it matches. When backlog.json moved on without it (plan, edits
+    from the Bun server) load() reconciles against per-item fingerprints:
+    removed and edited items are stripped, new and edited ones re-added.
+    """
+
+    __slots__ = ("terms", "categories", "efforts", "docs")
+
+    def __init__(self):
+        self.terms = {}
+        self.categories = {}
+        self.efforts = {}
+        self.docs = {}  # item id -> item_fingerprint()
+
+    @classmethod
+    def build(cls, backlog):
+        index = cls()
+        for item in backlog:
+            index.add(item)
+        return index
+
+    @classmethod
+    def load(cls, backlog):
+        data = read_json(INDEX_FILE)
+        if data is None or "docs" not in data:
+            index = cls.build(backlog)
+            index.save(backlog)
+            return index
+        index = cls()
+        index.terms = {k: set(v) for k, v in data["terms"].items()}
+        index.categories = {k: set(v) for k, v in data["categories"].items()}
+        index.efforts = {effort: set(ids) for effort, ids in data["efforts"]}
+        index.docs = data["docs"]
+        stamp = backlog.stamp()
+        if any(data.get(k) != v for k, v in stamp.items()):
+            index.reconcile(backlog)
+            index.save(backlog)
+        return index
+
+    def reconcile(self, backlog):
+        current = {item["id"]: item for item in backlog}
+        stale = {
+            item_id for item_id, fp in self.docs.items()
+            if item_id not in current or item_fingerprint(current[item_id]) != fp
+        }
+        if stale:
+            for postings in (self.terms, self.categories, self.efforts):
+                for key in list(postings):
+                    postings[key] -= stale
+                    if not postings[key]:
+                        del postings[key]
+            for item_id in stale:
+                del self.docs[item_id]
+        for item_id, item in current.items():
+            if item_id not in self.docs:
+                self.add(item)
+
+    def save(self, backlog):
+        write_json(INDEX_FILE, {
+            **backlog.stamp(),
+            "docs": self.docs,
+            "terms": {k: sorted(v) for k, v in self.terms.items()},
+            "categories": {k: sorted(v) for k, v in self.categories.items()},
+            # pairs, not an object: effort may be any JSON number
+            "efforts": [[k, sorted(v)] for k, v in self.efforts.items()],
+        })
+
+    def add(self, item):
+        item_id = item["id"]
+        for token in item_tokens(item):
+            self.terms.setdefault(token, set()).add(item_id)
+        self.categories.setdefault(item.get("category", "build"), set()).add(item_id)
+        effort = item.get("effort_minutes", 30)
+        if isinstance(effort, (int, float)):
+            self.efforts.setdefault(effort, set()).add(item_id)
+        self.docs[item_id] = item_fingerprint(item)
+
+    def remove(self, item):
+        item_id = item["id"]
+        for postings, key in (
+            *((self.terms, token) for token in item_tokens(item)),
+            (self.categories, item.get("category", "build")),
+            (self.efforts, item.get("effort_minutes", 30)),
+        ):
+            ids = postings.get(key)
+            if ids is not None:
+                ids.discard(item_id)
+                if not ids:
+                    del postings[key]
+        self.docs.pop(item_id, None)
+
+    def all_ids(self):
+        return set(self.docs)
+
+    def search(self, query="", category=None, max_effort=None):
+        result = None
+        # rarest postings first keeps the intersections small
+        tokens = sorted(set(tokenize(query)), key=lambda t: len(self.terms.get(t, ())))
+        for token in tokens:
+            ids = self.terms.get(token, set())
+            result = set(ids) if result is None else result & ids
+            if not result:
+                return set()
+        if category:
+            ids = self.categories.get(category, set())
+            result = set(ids) if result is None else result & ids
+        if max_effort is not None:
+            ids = set().union(*(v for k, v in self.efforts.items() if k <= max_effort))
+            result = ids if result is None else result & ids
+        return self.all_ids() if result is None else result
+
+
+def search_backlog(backlog, index, query="", category=None, max_effort=None):
+    ids = index.search(query, category, max_effort)
+    return [backlog[i] for i, item_id in enumerate(backlog.values("id")) if item_id in ids]
+
+
+def update_backlog(mutate, backlog=None):
+    # update_json for backlog.json: mutate(backlog) is re-applied to a fresh
+    # load whenever the file changed since it was read. mutate returning
+    # None skips the write.
+    for attempt in range(WRITE_RETRIES):
+        if attempt:
+            _backoff(attempt)
+        if backlog is None or attempt:
+            backlog = Backlog.load()
+        result = mutate(backlog)
+        if result is None:
+            return backlog, None
+        try:
+            backlog.save()
+        except StaleWriteError:
+            continue
+        return backlog, result
+    raise ConcurrentWriteError("backlog.json: muitas escritas concorrentes, tente de novo")
+
+# ---------------------------------------------------------------------------
+# Duplicate detection – MinHash signatures with LSH banding
+# ---------------------------------------------------------------------------
+
+DEDUPE_FILE = "backlog.minhash.json"
+DEDUPE_MODES = ("flag", "merge", "skip")
+MINHASH_PERMS = 64
+MINHASH_BITS = 16  # values kept per permutation; 128 bytes per signature
+LSH_BANDS = 16     # 4 rows per band: pairs above ~0.5 similarity become candidates
+SHINGLE_SIZE = 3
+
+MINHASH_SCHEME = "crc32-xor"
+_minhash_rng = random.Random("questgame-minhash")
+# one crc32 per shingle, XOR-ed with a fixed mask per permutation
+MINHASH_MASKS = [_minhash_rng.getrandbits(32) for _ in range(MINHASH_PERMS)]
+
+
+def shingles(text, k=SHINGLE_SIZE):
+    text = " ".join(tokenize(text))
+    if len(text) <= k:
+        return {text} if text else set()
+    return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+
+def minhash(text):
+    # crc32 instead of hash(): signatures are persisted across processes.
+    # Only the low 16 bits of each minimum are kept, packed little-endian.
+    hashes = [zlib.crc32(s.encode("utf-8")) for s in shingles(text)]
+    if not hashes:
+        return None
+    sig = array.array("H", (min(h ^ mask for h in hashes) & 0xFFFF for mask in MINHASH_MASKS))
+    if sys.byteorder == "big":
+        sig.byteswap()
+    return sig.tobytes()
+
+
+def title_hash(title):
+    return zlib.crc32(title.encode("utf-8"))
+
+
+def _sig_values(sig):
+    values = array.array("H", sig)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+class DuplicateIndex:
+    """MinHash signatures of backlog titles, bucketed by LSH band.
+
+    Signatures are persisted base64-encoded in a compact file together with
+    a hash of the title they were computed from; band buckets are rebuilt on
+    load.
+    """
+
+    __slots__ = ("signatures", "titles", "buckets", "dirty")
+
+    def __init__(self):
+        self.signatures = {}
+        self.titles = {}  # item id -> title_hash() the signature belongs to
+        self.buckets = [{} for _ in range(LSH_BANDS)]  # per band: band bytes -> ids
+        self.dirty = False
+
+    @classmethod
+    def load(cls, backlog):
+        index = cls()
+        data = read_json(DEDUPE_FILE) or {}
+        signatures = {}
+        if (data.get("scheme") == MINHASH_SCHEME and data.get("perms") == MINHASH_PERMS
+                and data.get("bits") == MINHASH_BITS):
+            signatures = data.get("signatures", {})
+
+        # reconcile with the backlog: ids that left it are dropped, only new
+        # or retitled items get shingled
+        for item_id, title in zip(backlog.values("id"), backlog.values("title", "")):
+            digest = title_hash(title)
+            stored = signatures.get(item_id)
+            if stored is not None and stored[0] == digest:
+                sig = base64.b64decode(stored[1])
+            else:
+                sig = minhash(title)
+                index.dirty = True
+            index.titles[item_id] = digest
+            if sig:
+                index._insert(item_id, sig)
+        if len(index.titles) != len(signatures):
+            index.dirty = True
+        return index
+
+    def save(self):
+        if not self.dirty:
+            return
+        # titles without shingles are kept with an empty signature so they
+        # are not recomputed on every load
+        signatures = {
+            k: [digest, base64.b64encode(self.signatures.get(k, b"")).decode("ascii")]
+            for k, digest in self.titles.items()
+        }
+        write_json(DEDUPE_FILE, {
+            "scheme": MINHASH_SCHEME,
+            "perms": MINHASH_PERMS,
+            "bits": MINHASH_BITS,
+            "signatures": signatures,
+        }, compact=True)
+        self.dirty = False
+
+    def _bands(self, sig):
+        width = len(sig) // LSH_BANDS
+        return zip(self.buckets, (sig[i:i + width] for i in range(0, len(sig), width)))
+
+    def _insert(self, item_id, sig):
+        self.signatures[item_id] = sig
+        for bucket, key in self._bands(sig):
+            ids = bucket.get(key)
+            if ids is None:
+                bucket[key] = [item_id]
+            else:
+                ids.append(item_id)
+
+    def add(self, item_id, title, sig):
+        self.titles[item_id] = title_hash(title)
+        if sig:
+            self._insert(item_id, sig)
+        self.dirty = True
+
+    def find(self, sig, threshold):
+        candidates = set()
+        for bucket, key in self._bands(sig):
+            candidates.update(bucket.get(key, ()))
+        best_id, best_sim = None, threshold
+        values = _sig_values(sig)
+        for item_id in candidates:
+            other = _sig_values(self.signatures[item_id])
+            sim = sum(1 for x, y in zip(values, other) if x == y) / MINHASH_PERMS
+            if sim >= best_sim:
+                best_id, best_sim = item_id, sim
+        return (best_id, best_sim) if best_id else None
+
 # ---------------------------------------------------------------------------
 # Step templates per category
 # ---------------------------------------------------------------------------
@@ -189,7 +842,8 @@ def score_quest(item, config, last_categories):
 
     base = impact * 10
     penalty = effort
-    bonus_variety = 15 if cat not in last_categories[-2:] else 0
+    variety_window = config.get("variety_window", 2)
+    bonus_variety = 15 if cat not in last_categories[-variety_window:] else 0
     bonus_entrepreneur = 10 if cat in ("ship", "reach") else 0
 
     return base - penalty + bonus_variety + bonus_entrepreneur
@@ -252,12 +906,336 @@ def update_table(state, category):
 # Golden rule: every 3 days at least 1 ship/reach
 # ---------------------------------------------------------------------------
 
-def should_force_entrepreneur(last_categories):
-    recent = last_categories[-3:]
-    if len(recent) < 3:
+def should_force_entrepreneur(last_categories, window=3):
+    recent = last_categories[-window:]
+    if len(recent) < window:
         return False
     return all(c == "build" for c in recent)
 
+# ---------------------------------------------------------------------------
+# Activity history and sliding-window rules
+# ---------------------------------------------------------------------------
+
+# window rules are opt-in: see "rules" in config.json for examples
+DEFAULT_RULES = []
+
+
+def encode_days(days):
+    # sorted day ordinals as runs: "738000x3,1x2,4" = 3 on day 738000,
+    # 2 the day after, 1 four days later
+    runs = []
+    prev = 0
+    i = 0
+    while i < len(days):
+        j = i
+        while j < len(days) and days[j] == days[i]:
+            j += 1
+        run = str(days[i] - prev)
+        runs.append(f"{run}x{j - i}" if j - i > 1 else run)
+        prev = days[i]
+        i = j
+    return ",".join(runs)
+
+
+def decode_days(text):
+    days = []
+    day = 0
+    for run in filter(None, text.split(",")):
+        delta, _, count = run.partition("x")
+        day += int(delta)
+        days.extend([day] * int(count or 1))
+    return days
+
+
+class ActivityHistory:
+    """Every done/event ever, as parallel arrays (category index, day ordinal)."""
+
+    __slots__ = ("cats", "days")
+
+    def __init__(self):
+        self.cats = array.array("B")
+        self.days = array.array("i")
+
+    @classmethod
+    def from_dict(cls, data):
+        history = cls()
+        history.cats.extend(CATEGORY_INDEX[CATEGORY_CODES[c]] for c in data.get("categories", ""))
+        days = data.get("days", "")
+        history.days.extend(days if isinstance(days, list) else decode_days(days))
+        return history
+
+    @classmethod
+    def from_log(cls):
+        # first run after upgrading: replay DONE/EVENT entries from the log
+        history = cls()
+        for line in read_text("log.ndjson").splitlines():
+            try:
+                entry = json.loads(line)
+                if entry.get("type") in ("DONE", "EVENT") and entry.get("category"):
+                    day = datetime.date.fromisoformat(entry["ts"][:10]).toordinal()
+                    history.append(entry["category"], day)
+            except (ValueError, KeyError):
+                continue
+        return history
+
+    def to_dict(self):
+        return {
+            "categories": "".join(CATEGORIES[c][0] for c in self.cats),
+            "days": encode_days(self.days),
+        }
+
+    def __len__(self):
+        return len(self.cats)
+
+    def append(self, category, day):
+        # keep days sorted so windows can slide forward only
+        if self.days:
+            day = max(day, self.days[-1])
+        self.cats.append(CATEGORY_INDEX.get(category, 0))
+        self.days.append(day)
+
+    def last(self, n):
+        return [CATEGORIES[c] for c in self.cats[-n:]] if n > 0 else []
+
+
+class RuleEngine:
+    """Evaluates window rules from per-window category counters.
+
+    Each window size keeps {head, tail, counts}: counts cover history[tail:head].
+    Recording an entry bumps head, and moving to a later day advances tail past
+    entries that fell out, so every update is amortized O(1).
+    """
+
+    __slots__ = ("rules", "history", "windows")
+
+    def __init__(self, rules, history, windows=None):
+        self.rules = rules
+        self.history = history
+        self.windows = {}
+        windows = windows or {}
+        for size in sorted({rule["window_days"] for rule in rules}):
+            window = windows.get(str(size))
+            if not window or window.get("head") != len(history):
+                window = self._rebuild(size)
+            self.windows[size] = window
+
+    @classmethod
+    def load(cls, state, config):
+        stats = state["stats"]
+        if "history" in stats:
+            history = ActivityHistory.from_dict(stats["history"])
+        else:
+            history = ActivityHistory.from_log()
+        return cls(config.get("rules", DEFAULT_RULES), history, stats.get("windows"))
+
+    def store(self, state):
+        state["stats"]["history"] = self.history.to_dict()
+        state["stats"]["windows"] = {str(size): w for size, w in self.windows.items()}
+
+    def _rebuild(self, size):
+        # new window size (or stale counters): one scan from the latest day
+        days = self.history.days
+        tail = bisect.bisect_right(days, days[-1] - size) if days else 0
+        counts = [0] * len(CATEGORIES)
+        for c in self.history.cats[tail:]:
+            counts[c] += 1
+        return {"head": len(days), "tail": tail, "counts": counts}
+
+    def advance(self, day):
+        cats, days = self.history.cats, self.history.days
+        for size, window in self.windows.items():
+            cutoff = day - size
+            while window["tail"] < window["head"] and days[window["tail"]] <= cutoff:
+                window["counts"][cats[window["tail"]]] -= 1
+                window["tail"] += 1
+
+    def record(self, category, day):
+        self.history.append(category, day)
+        c = self.history.cats[-1]
+        for window in self.windows.values():
+            window["counts"][c] += 1
+            window["head"] += 1
+        self.advance(self.history.days[-1])
+
+    def verdicts(self, day):
+        self.advance(day)
+        out = []
+        for rule in self.rules:
+            window = self.windows[rule["window_days"]]
+            cat = rule["category"]
+            count = window["counts"][CATEGORY_INDEX[cat]]
+            total = sum(window["counts"])
+            verdict = {
+                "name": rule.get("name", cat),
+                "category": cat,
+                "window_days": rule["window_days"],
+                "count": count,
+                "total": total,
+                "ok": True,
+            }
+            if "min_count" in rule:
+                verdict["min_count"] = rule["min_count"]
+                verdict["ok"] = count >= rule["min_count"]
+            if "max_ratio" in rule:
+                verdict["max_ratio"] = rule["max_ratio"]
+                verdict["ok"] = verdict["ok"] and (total == 0 or count / total <= rule["max_ratio"])
+            out.append(verdict)
+        return out
+
+
+def describe_verdict(v):
+    if "min_count" in v:
+        return f"{v['category'].upper()} {v['count']}/{v['min_count']} em {v['window_days']} dias"
+    ratio = v["count"] / v["total"] if v["total"] else 0
+    return f"{v['category'].upper()} {ratio:.0%} (max {v['max_ratio']:.0%}) em {v['window_days']} dias"
+
+
+def rule_constraints(engine, config, day):
+    # categories the plan for `day` must include, and categories to avoid.
+    # The golden rule wins: config rules that fight it are marked "ignored".
+    window = config.get("golden_rule_window", 3)
+    golden = set()
+    if should_force_entrepreneur(engine.history.last(window), window):
+        golden = {"ship", "reach"}
+    verdicts = engine.verdicts(day)
+    failing = [v for v in verdicts if not v["ok"]]
+    wanted = {v["category"] for v in failing if "min_count" in v}
+    blocked = {v["category"] for v in failing if "max_ratio" in v}
+    required = (golden & wanted) or golden or wanted
+    if golden:
+        for v in failing:
+            if ("min_count" in v) != (v["category"] in required):
+                v["ignored"] = True
+    return required, blocked - required, verdicts
+
+
+def recent_categories(engine, config):
+    window = max(config.get("variety_window", 2), config.get("golden_rule_window", 3))
+    return engine.history.last(window)
+
+# ---------------------------------------------------------------------------
+# Multi-day planner – knapsack packing against the daily effort budget
+# ---------------------------------------------------------------------------
+
+PLAN_MAX_CANDIDATES = 240  # shortlist size per day, split across categories
+PLAN_UNDER_PENALTY = 1     # points per minute left below the daily target
+PLAN_OVER_PENALTY = 10     # points per minute above it (one impact point)
+
+
+def pack_value(item, config, last_categories):
+    # score_quest minus its effort penalty: here effort is the knapsack weight
+    return score_quest(item, config, last_categories) + item.get("effort_minutes", 30)
+
+
+def shortlist_candidates(pool, values, limit=PLAN_MAX_CANDIDATES):
+    # keep the best value-per-minute items of every category so the DP stays
+    # small and ship/reach options survive the cut
+    per_cat = max(1, limit // len(CATEGORIES))
+    by_cat = {}
+    for item, value in zip(pool, values):
+        density = value / max(1, item.get("effort_minutes", 30))
+        by_cat.setdefault(item.get("category", "build"), []).append((density, value, item))
+    shortlist = []
+    for ranked in by_cat.values():
+        ranked.sort(key=lambda x: x[0], reverse=True)
+        shortlist.extend(ranked[:per_cat])
+    return [item for _, _, item in shortlist], [value for _, value, _ in shortlist]
+
+
+def pack_day(items, values, target, max_effort, required=()):
+    # 0/1 knapsack over minutes; layer 1 only holds packs that include at
+    # least one item of a required category (golden rule, min_count rules)
+    neg = float("-inf")
+    best = [[neg] * (max_effort + 1) for _ in range(2)]
+    best[0][0] = 0
+    took = []
+    for item, value in zip(items, values):
+        weight = max(1, item.get("effort_minutes", 30))
+        wanted = item.get("category") in required
+        took_item = {}
+        for t in range(max_effort, weight - 1, -1):
+            for layer in (0, 1):
+                prev = best[layer][t - weight]
+                if prev == neg:
+                    continue
+                new_layer = 1 if wanted else layer
+                if prev + value > best[new_layer][t]:
+                    best[new_layer][t] = prev + value
+                    took_item[(new_layer, t)] = layer
+        took.append(took_item)
+
+    # pick the best end state around the target; overshooting up to
+    # max_effort is allowed but costs an impact point per extra minute
+    layers = (1,) if required and max(best[1]) > neg else (0, 1)
+    end, end_score = None, neg
+    for layer in layers:
+        for t in range(1, max_effort + 1):
+            if best[layer][t] == neg:
+                continue
+            if t > target:
+                score = best[layer][t] - (t - target) * PLAN_OVER_PENALTY
+            else:
+                score = best[layer][t] - (target - t) * PLAN_UNDER_PENALTY
+            if score > end_score:
+                end, end_score = (layer, t), score
+    if end is None:
+        return []
+
+    chosen = []
+    layer, t = end
+    for i in range(len(items) - 1, -1, -1):
+        if (layer, t) in took[i]:
+            chosen.append(items[i])
+            layer = took[i][(layer, t)]
+            t -= max(1, items[i].get("effort_minutes", 30))
+    chosen.reverse()
+    return chosen
+
+
+def plan_schedule(items, config, engine, days, active=None):
+    target = config.get("daily_effort_target_minutes", 35)
+    max_effort = config.get("daily_effort_max_minutes", 50)
+    # simulate the plan on a copy so rules see the days already planned
+    engine = copy.deepcopy(engine)
+    start = datetime.date.today().toordinal()
+    pool = [i for i in items if i.get("effort_minutes", 30) <= max_effort]
+    schedule = []
+
+    # an active quest already takes part of today's budget
+    used_today = 0
+    if active:
+        used_today = active.get("effort_minutes", 30)
+        engine.record(active.get("category", "build"), start)
+
+    for day in range(start, start + days):
+        if not pool:
+            break
+        used = used_today if day == start else 0
+        day_max = max_effort - used
+        if day_max < 1:
+            schedule.append([])
+            continue
+        required, blocked, _ = rule_constraints(engine, config, day)
+        day_pool = [i for i in pool if i.get("category", "build") not in blocked] or pool
+        recent = recent_categories(engine, config)
+        values = [pack_value(i, config, recent) for i in day_pool]
+        shortlist, short_values = shortlist_candidates(day_pool, values)
+        chosen = pack_day(shortlist, short_values, max(0, target - used), day_max, required)
+        if not chosen:
+            if used:
+                schedule.append([])
+                continue
+            break
+        # most valuable first: plan takes a day's items in this order
+        chosen.sort(key=lambda i: score_quest(i, config, recent), reverse=True)
+        picked = {i["id"] for i in chosen}
+        pool = [i for i in pool if i["id"] not in picked]
+        for item in chosen:
+            engine.record(item.get("category", "build"), day)
+        schedule.append(chosen)
+
+    return schedule
+
 # ---------------------------------------------------------------------------
 # Commands
 # ---------------------------------------------------------------------------
@@ -294,7 +1272,7 @@ def cmd_add(args):
     text = " ".join(args.text)
     ts = now_iso()
     line = f"- [{ts}] {text}\n"
-    with open(path("inbox.md"), "a", encoding="utf-8") as f:
+    with file_lock("inbox.md"), open(path("inbox.md"), "a", encoding="utf-8") as f:
         f.write(line)
     print(f"  adicionado ao inbox: {text}")
 
@@ -336,84 +1314,163 @@ def cmd_status(_args):
     print()
 
 
-def cmd_triage(_args):
+def cmd_triage(args):
+    # holds the inbox for the whole run: `add` waits, and a second triage
+    # cannot pick up lines this one is still moving
+    with file_lock("inbox.md"):
+        triage_inbox(args)
+
+
+def triage_inbox(args):
     inbox_text = read_text("inbox.md").strip()
     if not inbox_text:
         print("  Inbox vazio. Use: add \"texto\"")
         return
 
-    backlog = read_json("backlog.json", DEFAULT_BACKLOG)
-    existing_ids = {item["id"] for item in backlog["items"]}
-    next_num = len(backlog["items"]) + 1
+    config = read_config()
+    dedupe_cfg = config.get("dedupe", {})
+    mode = getattr(args, "dupes", None) or dedupe_cfg.get("mode", "flag")
+    threshold = dedupe_cfg.get("threshold", 0.7)
     lines = [l.strip() for l in inbox_text.splitlines() if l.strip()]
-    added = 0
-
-    for line in lines:
-        text = line.lstrip("- ").strip()
-        # remove timestamp if present
-        if text.startswith("[") and "]" in text:
-            text = text[text.index("]") + 1:].strip()
-        if not text:
-            continue
 
-        item_id = f"B-{next_num:04d}"
-        while item_id in existing_ids:
-            next_num += 1
-            item_id = f"B-{next_num:04d}"
+    def apply(backlog):
+        # output is collected, not printed: a conflicting save runs this again
+        index = SearchIndex.load(backlog)
+        dupes = DuplicateIndex.load(backlog)
+        existing_ids = set(backlog.values("id"))
+        next_num = len(backlog) + 1
+        out = []
+        added = 0
+        skipped = 0
+
+        for line in lines:
+            text = line.lstrip("- ").strip()
+            # remove timestamp if present
+            if text.startswith("[") and "]" in text:
+                text = text[text.index("]") + 1:].strip()
+            if not text:
+                continue
 
-        category = detect_category(text)
-        item = {
-            "id": item_id,
-            "title": text,
-            "category": category,
-            "impact": 3,
-            "effort_minutes": 30,
-            "notes": "",
-            "created_at": now_iso(),
-        }
-        backlog["items"].append(item)
-        existing_ids.add(item_id)
-        next_num += 1
-        added += 1
-        print(f"  [{item_id}] {category.upper():5s} → {text}")
+            sig = minhash(text)
+            match = dupes.find(sig, threshold) if sig else None
+            if match and mode != "flag":
+                dup_id, sim = match
+                skipped += 1
+                if mode == "merge":
+                    existing = backlog[backlog.index_of(dup_id)]
+                    index.remove(existing)
+                    notes = existing.get("notes", "")
+                    existing["notes"] = f"{notes}\n{text}" if notes else text
+                    index.add(existing)
+                    out.append(f"  [{dup_id}] ~{sim:.0%} mesclado ← {text}")
+                else:
+                    out.append(f"  [{dup_id}] ~{sim:.0%} duplicado, ignorado: {text}")
+                continue
 
-    write_json("backlog.json", backlog)
+            item_id = f"B-{next_num:04d}"
+            while item_id in existing_ids:
+                next_num += 1
+                item_id = f"B-{next_num:04d}"
+
+            category = detect_category(text)
+            item = {
+                "id": item_id,
+                "title": text,
+                "category": category,
+                "impact": 3,
+                "effort_minutes": 30,
+                "notes": "",
+                "created_at": now_iso(),
+            }
+            if match:
+                item["duplicate_of"] = match[0]
+            backlog.append(item)
+            index.add(item)
+            dupes.add(item_id, text, sig)
+            existing_ids.add(item_id)
+            next_num += 1
+            added += 1
+            flag = f"  (parecido com {match[0]})" if match else ""
+            out.append(f"  [{item_id}] {category.upper():5s} → {text}{flag}")
+        return index, dupes, out, added, skipped
+
+    backlog, (index, dupes, out, added, skipped) = update_backlog(apply)
+    # after the backlog: the index records the stamp of the version just written
+    index.save(backlog)
+    dupes.save()
     write_text("inbox.md", "")
+
+    print("\n".join(out))
     print(f"\n  ✔ {added} item(ns) movidos para o backlog. Inbox limpo.")
+    if skipped:
+        print(f"  {skipped} duplicado(s) {'mesclado(s)' if mode == 'merge' else 'ignorado(s)'}.")
+
+
+def scheduled_item(backlog):
+    # first item planned for today by plan --days that is still in the backlog
+    schedule = read_json("schedule.json", {})
+    for day in schedule.get("days", []):
+        if day.get("date") != today_str():
+            continue
+        for item_id in day.get("items", []):
+            i = backlog.index_of(item_id)
+            if i >= 0:
+                return backlog[i]
+    return None
+
+
+def pick_quest(backlog, state, config):
+    engine = RuleEngine.load(state, config)
+    last_cats = recent_categories(engine, config)
+    max_effort = config.get("daily_effort_max_minutes", 50)
+
+    candidates = [i for i in backlog if i.get("effort_minutes", 30) <= max_effort]
+    if not candidates:
+        candidates = list(backlog)
+
+    required, blocked, verdicts = rule_constraints(engine, config, datetime.date.today().toordinal())
+    for v in verdicts:
+        if v.get("ignored"):
+            print(f"  ⚡ Regra {v['name']} ignorada, conflita com a regra de ouro: {describe_verdict(v)}")
+        elif not v["ok"]:
+            print(f"  ⚡ Regra {v['name']}: {describe_verdict(v)}")
+
+    allowed = [i for i in candidates if i["category"] not in blocked]
+    if allowed:
+        candidates = allowed
+    if required:
+        preferred = [i for i in candidates if i["category"] in required]
+        if preferred:
+            candidates = preferred
+            cats = "/".join(c.upper() for c in CATEGORIES if c in required)
+            print(f"  ⚡ Priorizando {cats}")
+
+    scored = [(score_quest(i, config, last_cats), i) for i in candidates]
+    scored.sort(key=lambda x: x[0], reverse=True)
+    return scored[0][1]
+
 
+def cmd_plan(args):
+    if getattr(args, "days", None):
+        cmd_plan_days(args.days)
+        return
 
-def cmd_plan(_args):
     today = read_json("today.json", DEFAULT_TODAY)
     if today.get("active"):
         print(f"  Ja tem quest ativa: {today['title']}")
         print("  Finalize com: done")
         return
 
-    backlog = read_json("backlog.json", DEFAULT_BACKLOG)
-    if not backlog["items"]:
+    backlog = Backlog.load()
+    if not len(backlog):
         print("  Backlog vazio. Use: add + triage primeiro.")
         return
 
-    state = read_json("state.json", DEFAULT_STATE)
-    config = read_config()
-    last_cats = state["stats"].get("last_categories", [])
-    target = config.get("daily_effort_target_minutes", 35)
-    max_effort = config.get("daily_effort_max_minutes", 50)
-
-    candidates = [i for i in backlog["items"] if i.get("effort_minutes", 30) <= max_effort]
-    if not candidates:
-        candidates = backlog["items"]
-
-    force_entrepreneur = should_force_entrepreneur(last_cats)
-    if force_entrepreneur:
-        entrepreneur_candidates = [i for i in candidates if i["category"] in ("ship", "reach")]
-        if entrepreneur_candidates:
-            candidates = entrepreneur_candidates
-            print("  ⚡ Regra de ouro: priorizando SHIP/REACH (3+ dias so em BUILD)")
-
-    scored = [(score_quest(i, config, last_cats), i) for i in candidates]
-    scored.sort(key=lambda x: x[0], reverse=True)
-    chosen = scored[0][1]
+    chosen = scheduled_item(backlog)
+    if chosen is not None:
+        print("  📅 Seguindo o plano de schedule.json")
+    else:
+        chosen = pick_quest(backlog, read_json("state.json", DEFAULT_STATE), read_config())
 
     quest_id = f"Q-{today_str()}-001"
     steps = generate_steps(chosen["category"], chosen["title"])
@@ -430,11 +1487,26 @@ def cmd_plan(_args):
         "source": "backlog",
         "backlog_id": chosen["id"],
     }
-    write_json("today.json", today_data)
 
-    # remove from backlog
-    backlog["items"] = [i for i in backlog["items"] if i["id"] != chosen["id"]]
-    write_json("backlog.json", backlog)
+    def claim(data):
+        # another plan may have won the race since today.json was read
+        if data.get("active"):
+            return None
+        data.clear()
+        data.update(today_data)
+        return True
+
+    _, claimed = update_json("today.json", claim, DEFAULT_TODAY)
+    if not claimed:
+        print("  Outra quest foi planejada ao mesmo tempo. Veja: status")
+        return
+
+    def take(b):
+        b.remove(chosen["id"])
+        return True
+
+    # remove from backlog; search and duplicate indexes drop it on their next load
+    update_backlog(take, backlog)
 
     print(f"\n  ── Quest do Dia ──")
     print(f"  {today_data['title']}")
@@ -445,57 +1517,141 @@ def cmd_plan(_args):
     print(f"\n  Boa quest! Quando terminar: done")
 
 
-def cmd_done(_args):
-    today = read_json("today.json", DEFAULT_TODAY)
-    if not today.get("active"):
-        print("  Nenhuma quest ativa. Use: plan")
+def cmd_plan_days(days):
+    backlog = Backlog.load()
+    if not len(backlog):
+        print("  Backlog vazio. Use: add + triage primeiro.")
         return
 
     state = read_json("state.json", DEFAULT_STATE)
     config = read_config()
-    player = state["player"]
+    engine = RuleEngine.load(state, config)
+    target = config.get("daily_effort_target_minutes", 35)
+    max_effort = config.get("daily_effort_max_minutes", 50)
 
-    # streak
-    last_done = player.get("last_done_date")
-    today_date = today_str()
-    yesterday = (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+    today = read_json("today.json", DEFAULT_TODAY)
+    active = today if today.get("active") else None
 
-    if last_done == yesterday:
-        player["streak"] += 1
-    elif last_done != today_date:
-        player["streak"] = 1
+    candidates = [i for i in backlog if i.get("effort_minutes", 30) <= max_effort]
+    schedule = plan_schedule(candidates, config, engine, days, active)
+    if not any(schedule):
+        print(f"  Nenhum item cabe em {max_effort} min por dia.")
+        return
 
-    player["last_done_date"] = today_date
+    start = datetime.date.today()
+    plan = {"created_at": now_iso(), "days": []}
+    print(f"\n  ── Plano de {len(schedule)} dia(s) ──  alvo ~{target} min/dia")
+    for n, items in enumerate(schedule):
+        date = (start + datetime.timedelta(days=n)).isoformat()
+        effort = sum(i.get("effort_minutes", 30) for i in items)
+        if n == 0 and active:
+            effort += active.get("effort_minutes", 30)
+        plan["days"].append({
+            "date": date,
+            "effort_minutes": effort,
+            "items": [i["id"] for i in items],
+        })
+        print(f"\n  Dia {n + 1} ({date})  ~{effort} min")
+        if n == 0 and active:
+            print(f"    (ativa) {active['category'].upper():5s} {active['title']}  ({active.get('effort_minutes', 30)} min)")
+        for i in items:
+            print(f"    [{i['id']}] {i['category'].upper():5s} {i['title']}  ({i.get('effort_minutes', 30)} min)")
+
+    write_json("schedule.json", plan)
+    if len(schedule) < days:
+        print(f"\n  Backlog so cobre {len(schedule)} de {days} dia(s).")
+    print(f"\n  Plano salvo em schedule.json. Para comecar: plan")
+
+
+def cmd_search(args):
+    query = " ".join(args.terms)
+    backlog = Backlog.load()
+    index = SearchIndex.load(backlog)
+    results = search_backlog(backlog, index, query, args.category, args.max_effort)
+    if not results:
+        print("  Nenhum item encontrado.")
+        return
 
-    # XP
-    impact = today.get("impact", 3)
-    category = today.get("category", "build")
-    xp = calc_xp(impact, category, player["streak"], config)
-    player["xp"] += xp
-    player["level"] = level_for_xp(player["xp"])
+    for item in results:
+        print(f"  [{item['id']}] {item['category'].upper():5s} → {item['title']}  ({item.get('effort_minutes', 30)} min)")
+    print(f"\n  {len(results)} item(ns) de {len(backlog)}.")
 
-    # loot
-    loot = roll_loot(category, player["streak"], today["id"], config)
-    state["inventory"].extend(loot)
-    if len(state["inventory"]) > 50:
-        state["inventory"] = state["inventory"][-50:]
 
-    # table
-    update_table(state, category)
+def cmd_done(_args):
+    today = read_json("today.json", DEFAULT_TODAY)
+    if not today.get("active"):
+        print("  Nenhuma quest ativa. Use: plan")
+        return
 
-    # stats
-    state["stats"]["last_categories"].append(category)
-    if len(state["stats"]["last_categories"]) > 10:
-        state["stats"]["last_categories"] = state["stats"]["last_categories"][-10:]
-    state["stats"]["total_done"] += 1
+    config = read_config()
+    impact = today.get("impact", 3)
+    category = today.get("category", "build")
+    # quest ids repeat every day (Q-<date>-001), created_at tells plans apart
+    quest_key = f"{today['id']}@{today.get('created_at', '')}"
+
+    def apply(state):
+        # checked inside the transaction: a concurrent done may have won
+        if state["stats"].get("last_quest") == quest_key:
+            return None
+        state["stats"]["last_quest"] = quest_key
+        player = state["player"]
+
+        # streak
+        last_done = player.get("last_done_date")
+        today_date = today_str()
+        yesterday = (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+
+        if last_done == yesterday:
+            player["streak"] += 1
+        elif last_done != today_date:
+            player["streak"] = 1
+
+        player["last_done_date"] = today_date
+
+        # XP
+        xp = calc_xp(impact, category, player["streak"], config)
+        player["xp"] += xp
+        player["level"] = level_for_xp(player["xp"])
+
+        # loot
+        loot = roll_loot(category, player["streak"], today["id"], config)
+        state["inventory"].extend(loot)
+        if len(state["inventory"]) > 50:
+            state["inventory"] = state["inventory"][-50:]
+
+        # table
+        update_table(state, category)
+
+        # stats
+        engine = RuleEngine.load(state, config)
+        engine.record(category, datetime.date.today().toordinal())
+        engine.store(state)
+        state["stats"]["last_categories"].append(category)
+        if len(state["stats"]["last_categories"]) > 10:
+            state["stats"]["last_categories"] = state["stats"]["last_categories"][-10:]
+        state["stats"]["total_done"] += 1
+        return xp, loot
+
+    def clear(data):
+        # only the quest this run completed, never one planned since
+        if data.get("id") != today["id"] or data.get("created_at") != today.get("created_at"):
+            return None
+        data.clear()
+        data["active"] = False
+        return True
+
+    state, result = update_json("state.json", apply, DEFAULT_STATE)
+    if result is None:
+        update_json("today.json", clear, DEFAULT_TODAY)
+        print("  Quest ja concluida.")
+        return
+    xp, loot = result
+    player = state["player"]
 
     # mark steps done
     for step in today.get("steps", []):
         step["done"] = True
 
-    state["player"] = player
-    write_json("state.json", state)
-
     # log
     log_entry = {
         "ts": now_iso(),
@@ -508,7 +1664,7 @@ def cmd_done(_args):
     append_ndjson("log.ndjson", log_entry)
 
     # clear today
-    write_json("today.json", {"active": False})
+    update_json("today.json", clear, DEFAULT_TODAY)
 
     # display
     rarity_label = ""
@@ -542,26 +1698,31 @@ def cmd_event(args):
         "revenue": "ship",
     }
     category = type_to_category[event_type]
-
-    state = read_json("state.json", DEFAULT_STATE)
     config = read_config()
-    player = state["player"]
 
-    # events give high XP
-    xp = calc_xp(5, category, player["streak"], config)
-    player["xp"] += xp
-    player["level"] = level_for_xp(player["xp"])
+    def apply(state):
+        player = state["player"]
+
+        # events give high XP
+        xp = calc_xp(5, category, player["streak"], config)
+        player["xp"] += xp
+        player["level"] = level_for_xp(player["xp"])
 
-    event_id = f"E-{today_str()}-{event_type}"
-    loot = roll_loot(category, player["streak"], event_id, config)
-    state["inventory"].extend(loot)
-    if len(state["inventory"]) > 50:
-        state["inventory"] = state["inventory"][-50:]
+        event_id = f"E-{today_str()}-{event_type}"
+        loot = roll_loot(category, player["streak"], event_id, config)
+        state["inventory"].extend(loot)
+        if len(state["inventory"]) > 50:
+            state["inventory"] = state["inventory"][-50:]
 
-    update_table(state, category)
+        update_table(state, category)
 
-    state["player"] = player
-    write_json("state.json", state)
+        engine = RuleEngine.load(state, config)
+        engine.record(category, datetime.date.today().toordinal())
+        engine.store(state)
+        return xp, loot
+
+    state, (xp, loot) = update_json("state.json", apply, DEFAULT_STATE)
+    player = state["player"]
 
     log_entry = {
         "ts": now_iso(),
@@ -581,16 +1742,7 @@ def cmd_event(args):
     print(f"  Level: {player['level']}   XP total: {player['xp']}\n")
 
 
-def cmd_sync(_args):
-    state = read_json("state.json", DEFAULT_STATE)
-    config = read_config()
-
-    if not state["git"].get("enabled", True):
-        print("  Git sync desabilitado.")
-        return
-
-    last_hash = state["git"].get("last_seen_hash")
-
+def git_new_commits(last_hash):
     try:
         if last_hash:
             result = subprocess.run(
@@ -604,22 +1756,25 @@ def cmd_sync(_args):
             )
     except (subprocess.TimeoutExpired, FileNotFoundError):
         print("  Erro ao acessar git.")
-        return
+        return None
 
     if result.returncode != 0:
         print("  Nao esta em um repositorio git ou erro no comando.")
-        return
+        return None
+
+    return [l.strip() for l in result.stdout.strip().splitlines() if l.strip()]
+
+
+def cmd_sync(_args):
+    state = read_json("state.json", DEFAULT_STATE)
+    config = read_config()
 
-    lines = [l.strip() for l in result.stdout.strip().splitlines() if l.strip()]
-    if not lines:
-        print("  Nenhum commit novo encontrado.")
+    if not state["git"].get("enabled", True):
+        print("  Git sync desabilitado.")
         return
 
-    player = state["player"]
     commit_xp = config.get("git", {}).get("commit_xp", 2)
     tag_xp = config.get("git", {}).get("tag_xp", 20)
-    total_xp = 0
-    total_loot = []
 
     # check tags
     try:
@@ -631,33 +1786,54 @@ def cmd_sync(_args):
     except (subprocess.TimeoutExpired, FileNotFoundError):
         has_tag = False
 
-    for line in lines:
-        parts = line.split("|", 1)
-        if len(parts) < 2:
-            continue
-        commit_hash, message = parts
-        xp = commit_xp
-        total_xp += xp
+    def apply(state):
+        # runs again if another writer got in first, so commits are
+        # always counted from the last_seen_hash actually being replaced
+        last_hash = state["git"].get("last_seen_hash")
+        lines = git_new_commits(last_hash)
+        if lines is None:
+            return None
+        if not lines:
+            print("  Nenhum commit novo encontrado.")
+            return None
+
+        player = state["player"]
+        total_xp = 0
+        total_loot = []
+
+        for line in lines:
+            parts = line.split("|", 1)
+            if len(parts) < 2:
+                continue
+            commit_hash, message = parts
+            xp = commit_xp
+            total_xp += xp
 
-        loot_item = "build_shard"
-        total_loot.append(loot_item)
+            loot_item = "build_shard"
+            total_loot.append(loot_item)
 
-    if has_tag:
-        total_xp += tag_xp
-        total_loot.append("ship_token")
-        print(f"  ★ Tag de release detectada! +{tag_xp} XP")
+        if has_tag:
+            total_xp += tag_xp
+            total_loot.append("ship_token")
 
-    player["xp"] += total_xp
-    player["level"] = level_for_xp(player["xp"])
-    state["inventory"].extend(total_loot)
-    if len(state["inventory"]) > 50:
-        state["inventory"] = state["inventory"][-50:]
+        player["xp"] += total_xp
+        player["level"] = level_for_xp(player["xp"])
+        state["inventory"].extend(total_loot)
+        if len(state["inventory"]) > 50:
+            state["inventory"] = state["inventory"][-50:]
 
-    # update last seen hash
-    newest_hash = lines[0].split("|")[0] if lines else last_hash
-    state["git"]["last_seen_hash"] = newest_hash
-    state["player"] = player
-    write_json("state.json", state)
+        # update last seen hash
+        state["git"]["last_seen_hash"] = lines[0].split("|")[0]
+        return lines, total_xp, total_loot
+
+    state, result = update_json("state.json", apply, DEFAULT_STATE)
+    if result is None:
+        return
+    lines, total_xp, total_loot = result
+    player = state["player"]
+
+    if has_tag:
+        print(f"  ★ Tag de release detectada! +{tag_xp} XP")
 
     log_entry = {
         "ts": now_iso(),
@@ -682,9 +1858,19 @@ class QuestHandler(http.server.SimpleHTTPRequestHandler):
 
     def do_GET(self):
         if self.path == "/api/state":
-            self._json_response(read_json("state.json", DEFAULT_STATE))
+            state = read_json("state.json", DEFAULT_STATE)
+            # the activity history grows without bound; pollers don't need it
+            for key in ("history", "windows"):
+                state["stats"].pop(key, None)
+            self._json_response(state)
         elif self.path == "/api/today":
             self._json_response(read_json("today.json", DEFAULT_TODAY))
+        elif self.path == "/api/rules":
+            state = read_json("state.json", DEFAULT_STATE)
+            engine = RuleEngine.load(state, read_config())
+            self._json_response(engine.verdicts(datetime.date.today().toordinal()))
+        elif self.path.startswith("/api/backlog"):
+            self._json_response(self._search_backlog())
         elif self.path.startswith("/api/log"):
             limit = 10
             if "limit=" in self.path:
@@ -706,6 +1892,23 @@ class QuestHandler(http.server.SimpleHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(body)
 
+    def _search_backlog(self):
+        params = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        query = params.get("q", [""])[0]
+        category = params.get("category", [None])[0]
+        max_effort = None
+        if "max_effort" in params:
+            try:
+                max_effort = int(params["max_effort"][0])
+            except ValueError:
+                pass
+        backlog = Backlog.load()
+        if not (query or category or max_effort is not None):
+            return backlog.to_dict()["items"]
+        index = SearchIndex.load(backlog)
+        results = search_backlog(backlog, index, query, category, max_effort)
+        return [item.to_dict() for item in results]
+
     def _read_log(self, limit):
         p = path("log.ndjson")
         if not os.path.exists(p):
@@ -746,6 +1949,13 @@ def cmd_serve(args):
 # Argument parser
 # ---------------------------------------------------------------------------
 
+def positive_int(value):
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"precisa ser >= 1: {value}")
+    return n
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog="quest",
@@ -759,10 +1969,18 @@ def main():
     p_add.add_argument("text", nargs="+", help="Texto da ideia")
 
     sub.add_parser("status", help="Mostra status atual")
-    sub.add_parser("triage", help="Transforma inbox em backlog")
-    sub.add_parser("plan", help="Escolhe quest do dia")
+    p_triage = sub.add_parser("triage", help="Transforma inbox em backlog")
+    p_triage.add_argument("--dupes", choices=DEDUPE_MODES,
+                          help="O que fazer com duplicados: flag (default), merge, skip")
+    p_plan = sub.add_parser("plan", help="Escolhe quest do dia")
+    p_plan.add_argument("--days", type=positive_int, default=None, help="Monta um plano para N dias")
     sub.add_parser("done", help="Finaliza quest do dia")
 
+    p_search = sub.add_parser("search", help="Busca itens no backlog")
+    p_search.add_argument("terms", nargs="*", help="Termos da busca")
+    p_search.add_argument("--category", choices=CATEGORIES, help="Filtra por categoria")
+    p_search.add_argument("--max-effort", type=int, help="Esforco maximo em minutos")
+
     p_event = sub.add_parser("event", help="Registra evento rapido")
     p_event.add_argument("event_type", help="Tipo: blog, tiktok, store, revenue")
     p_event.add_argument("note", nargs="*", help="Nota opcional")
@@ -780,6 +1998,7 @@ def main():
         "status": cmd_status,
         "triage": cmd_triage,
         "plan": cmd_plan,
+        "search": cmd_search,
         "done": cmd_done,
         "event": cmd_event,
         "sync": cmd_sync,
@@ -787,7 +2006,11 @@ def main():
     }
 
     if args.command in commands:
-        commands[args.command](args)
+        try:
+            commands[args.command](args)
+        except ConcurrentWriteError as e:
+            print(f"  Erro: {e}")
+            sys.exit(1)
     else:
         parser.print_help()
 